@@ -24,11 +24,16 @@ Use like this:
 When an error happens in ntc-cli, the run(...) function will raise a RuntimeError.
 """
 
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields, Field
+from functools import lru_cache
 from typing import Optional, List, Tuple, Any, Callable
-from argparse import Namespace
+import asyncio
+import builtins
 import subprocess
 import re
+import shlex
 import os
 import signal
 import sys
@@ -47,7 +52,7 @@ def get_default_tool_path():
     filename = 'bin/windows-x64/ntc-cli.exe' if os.name == 'nt' else 'bin/linux-x64/ntc-cli'
     return os.path.join(sdkroot, filename)
 
-@dataclass
+@dataclass(slots=True)
 class LatentShape:
     gridSizeScale: int
     highResFeatures: int
@@ -55,7 +60,7 @@ class LatentShape:
     lowResFeatures: int
     lowResQuantBits: int
 
-@dataclass
+@dataclass(slots=True)
 class Arguments:
     """
     A structure that defines arguments for executing ntc-cli.
@@ -65,7 +70,8 @@ class Arguments:
     # Path to the ntc-cli executable, required
     tool: str
 
-    # Extra arguments for ntc-cli, passed verbatim
+    # Extra arguments for ntc-cli, split like a shell command line (quotes are supported, backslashes are literal).
+    # An unbalanced quote, such as in O'Brien, makes get_command_line() raise ValueError.
     customArguments: str = ''
     
     # Graphics API, can be 'dx12' or 'vk'
@@ -125,69 +131,104 @@ class Arguments:
         "Returns the command line with the provided arguments, as a list passable to subprocess.call."
 
         result = [self.tool]
-        for name, value in self.__dict__.items():
-            # Process the special case fields
-            if name == 'tool':
-                pass
-            elif name == 'customArguments':
-                if value is not None: result += value.split(' ')
-            elif name == 'graphicsApi':
-                if value == 'vk': result.append('--vk')
-                elif value == 'dx12': result.append('--dx12')
-                elif value != '': raise ValueError(f'Unrecognized graphicsApi = {value}')
-            elif name == 'noCoopVec':
-                if value: result.append('--no-coopVec')
-            elif name == 'noCoopVecInt8':
-                if value: result.append('--no-coopVecInt8')
-            elif name == 'noCoopVecFP8':
-                if value: result.append('--no-coopVecFP8')
-            elif name == 'noDP4a':
-                if value: result.append('--no-dp4a')
-            elif name == 'noFloat16':
-                if value: result.append('--no-float16')
-            else:
-                # Generic fields - decide what to do based on the data type
-                if value is None or value == '':
-                    # Skip unset parameters
-                    pass
-                elif isinstance(value, bool):
-                    # Boolean parameters are just switches if the value is True
-                    if value: result.append(f'--{name}')
-                elif isinstance(value, (int, float, str)):
-                    # Simple data types are passed by value
-                    result.append(f'--{name}')
-                    result.append(str(value))
-                elif isinstance(value, LatentShape):
-                    # Expand the LatentShape members
-                    for name2, value2 in value.__dict__.items():
-                        result.append(f'--{name2}')
-                        result.append(str(value2))
-                else:
-                    raise ValueError(f'Unrecognized value type for {name} = {repr(value)}')
+        for name, emit in _argumentEmitters:
+            emit(getattr(self, name), result)
         return result
 
-
-@dataclass
+# Functions that append the command line arguments for a field of Arguments, called as emit(value, out).
+
+@lru_cache(maxsize=16)
+def _split_custom_arguments(value: str) -> Tuple[str, ...]:
+    # Split the string like a POSIX shell would, so that quoted arguments with spaces stay intact,
+    # but without backslash escapes because those are path separators on Windows.
+    # The result is cached because all tasks in a batch usually share the same custom arguments.
+    # Like shlex.split, don't treat '#' as the start of a comment.
+    lexer = shlex.shlex(value, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    lexer.escape = ''
+    return tuple(lexer)
+
+def _emit_custom_arguments(value: Optional[str], out: List[str]):
+    if value: out += _split_custom_arguments(value)
+
+def _emit_graphics_api(value: str, out: List[str]):
+    if value == 'vk': out.append('--vk')
+    elif value == 'dx12': out.append('--dx12')
+    elif value != '': raise ValueError(f'Unrecognized graphicsApi = {value}')
+
+def _make_switch_emitter(option: str):
+    # Boolean parameters are just switches if the value is True
+    def _emit_switch(value: bool, out: List[str]):
+        if value: out.append(option)
+    return _emit_switch
+
+def _make_value_emitter(option: str):
+    # Simple data types are passed by value, unset parameters are skipped
+    def _emit_value(value: Any, out: List[str]):
+        if value is not None and value != '':
+            out.append(option)
+            out.append(str(value))
+    return _emit_value
+
+def _emit_latent_shape(value: Optional[LatentShape], out: List[str]):
+    # Expand the LatentShape members
+    if value is not None:
+        for name, option in _latentShapeOptions:
+            out.append(option)
+            out.append(str(getattr(value, name)))
+
+_latentShapeOptions = [(f.name, f'--{f.name}') for f in fields(LatentShape)]
+
+# Emitters for the fields that don't follow the generic rules
+_specialArgumentEmitters = {
+    'customArguments': _emit_custom_arguments,
+    'graphicsApi': _emit_graphics_api,
+    'noCoopVec': _make_switch_emitter('--no-coopVec'),
+    'noCoopVecInt8': _make_switch_emitter('--no-coopVecInt8'),
+    'noCoopVecFP8': _make_switch_emitter('--no-coopVecFP8'),
+    'noDP4a': _make_switch_emitter('--no-dp4a'),
+    'noFloat16': _make_switch_emitter('--no-float16'),
+}
+
+def _make_argument_emitter(f: Field):
+    special = _specialArgumentEmitters.get(f.name)
+    if special is not None:
+        return special
+    if f.type is bool:
+        return _make_switch_emitter(f'--{f.name}')
+    if f.type in (LatentShape, Optional[LatentShape]):
+        return _emit_latent_shape
+    if f.type in (int, float, str, Optional[int], Optional[float], Optional[str]):
+        return _make_value_emitter(f'--{f.name}')
+    raise TypeError(f'Unsupported type for Arguments.{f.name}: {f.type}')
+
+# (name, emit) for every field of Arguments except 'tool', built once from the field types
+# so that get_command_line doesn't need to inspect the values' types on every call.
+_argumentEmitters = [(f.name, _make_argument_emitter(f)) for f in fields(Arguments) if f.name != 'tool']
+
+
+@dataclass(slots=True)
 class CompressionRun:
     bitsPerPixel: Optional[float] = None
-    learningCurve: Optional[List[Tuple[int, float, float]]] = None # (steps, ms/step, psnr)
+    learningCurve: List[Tuple[int, float, float]] = field(default_factory=list) # (steps, ms/step, psnr)
 
-@dataclass
+@dataclass(slots=True)
 class Result:
     elapsedTime: float = 0 # total ntc-cli execution time in seconds
     overallPsnr: Optional[float] = None
     overallPsnrFP8: Optional[float] = None
-    perMipPsnr: Optional[List[float]] = None
+    perMipPsnr: List[float] = field(default_factory=list)
     bitsPerPixel: Optional[float] = None
     combinedBcPsnr: Optional[float] = None
     combinedBcBitsPerPixel: Optional[float] = None
-    compressionRuns: Optional[List[CompressionRun]] = None
+    compressionRuns: List[CompressionRun] = field(default_factory=list)
     decompressionTime: Optional[float] = None
     savedFileSize: Optional[int] = None
     savedFileBpp: Optional[float] = None
     gpuName: str = ''
     graphicsApi: str = ''
-    gpuFeatures: Optional[List[str]] = None # may contain 'DP4a', 'FP16', 'CoopVecInt8', 'CoopVecFP8'
+    gpuFeatures: List[str] = field(default_factory=list) # may contain 'DP4a', 'FP16', 'CoopVecInt8', 'CoopVecFP8'
 
     # describe command output:
     dimensions: Optional[Tuple[int, int]] = None # (width, height)
@@ -211,37 +252,166 @@ class RuntimeError(Exception):
         if self.stderr: s += f'stderr:\n{self.stderr}'
         return s
 
-def _create_or_append_list(lst: Optional[List[Any]], x: Any) -> List[Any]:
-    if lst is None:
-        return [x]
-    lst.append(x)
-    return lst
-
-class Regex:
-    def __init__(self, pattern: str):
-        self.regex = re.compile(pattern)
-
-    def parse(self, line: str):
-        match = self.regex.match(line)
-        if not match:
-            return None
-        return Namespace(**match.groupdict())
-
-_baseCompRateRegex = Regex(r'Base compression rate: --bitsPerPixel (?P<bpp>[0-9\.]+)')
-_bppRegex = Regex(r'Selected compression rate: (?P<bpp>[0-9\.]+) bpp, (?P<psnr>[0-9\.]+|inf) dB PSNR')
-_bcQualityRegex = Regex(r'Combined BCn PSNR: (?P<psnr>[0-9\.]+|inf) dB, bit rate: (?P<bpp>[0-9\.]+) bpp')
-_cudaDecompressionTimeRegex = Regex(r'CUDA decompression time: (?P<milliseconds>[0-9\.]+) ms')
-_dimensionsRegex = Regex(r'Dimensions: (?P<width>\d+)x(?P<height>\d+), (?P<channels>\d+) channels, (?P<mipLevels>\d+) mip level\(s\)')
-_experimentRegex = Regex(r'Experiment (?P<index>\d+): (?P<bpp>[0-9\.]+) bpp')
-_fileSizeRegex = Regex(r'File size: (?P<bytes>\d+) bytes, (?P<bpp>[0-9\.]+) bits per pixel')
-_graphicsDecompressionTimeRegex = Regex(r'Median decompression time over \d+ iterations: (?P<milliseconds>[0-9\.]+) ms')
-_latentShapeRegex = Regex(r'Latent shape: --gridSizeScale (?P<gss>\d+) --highResFeatures (?P<hrf>\d+) '
-                         r'--lowResFeatures (?P<lrf>\d+) --highResQuantBits (?P<hrqb>\d+) --lowResQuantBits (?P<lrqb>\d+)')
-_mipRegex = Regex(r'MIP\s+(?P<mipLevel>\d+)\s+PSNR: (?P<psnr>[0-9\.]+|inf) dB')
-_networkVersionRegex = Regex(r'Network version: (?P<version>[A-Z_]+)')
-_overallPsnrRegex = Regex(r'Overall PSNR \((?P<type>\w+) weights\): (?P<psnr>[0-9\.]+|inf) dB')
-_stepRegex = Regex(r'Training: (?P<steps>\d+) steps, (?P<milliseconds>[0-9\.]+) ms/step, intermediate PSNR: (?P<psnr>[0-9\.]+|inf) dB')
-_systemRegex = Regex(r'Using (?P<gpu>.+) with (?P<api>.+) API\. DP4a \[(?P<dp4a>[YN])\], FP16 \[(?P<fp16>[YN])\], CoopVec-Int8 \[(?P<coopVecInt8>[YN])\], CoopVec-FP8 \[(?P<coopVecFP8>[YN])\]')
+# Number of trailing stdout lines to include into RuntimeError when the tool fails
+_STDOUT_TAIL_LINES = 100
+
+# Size of the chunks in which the tool output is read
+_READ_CHUNK_SIZE = 65536
+
+# On POSIX, close_fds=False allows Python to launch the tool with posix_spawn instead of fork+exec, which is faster
+# for processes with large memory footprint. Python's own file descriptors are non-inheritable anyway.
+# On Windows, close_fds=True makes Python pass only the pipe handles of each process to it, so that concurrently
+# launched processes don't inherit each other's pipes and keep them open.
+_CLOSE_FDS = os.name == 'nt'
+
+class _ParserState:
+    "Accumulates the interpreted ntc-cli output while it is being parsed."
+
+    def __init__(self, result: Result):
+        self.result = result
+        self.compressionRun = CompressionRun()
+        # The last few parsed blocks of output, for error reporting. Every block contains at least one line.
+        self.tail = deque(maxlen=_STDOUT_TAIL_LINES)
+        # The incomplete last line for the output that arrives in chunks, see feed(...)
+        self.pendingLine = b''
+
+    def parse(self, buffer: bytes, end: int):
+        "Parses the complete lines of raw tool output in buffer[:end]."
+        self.tail.append(buffer[:end])
+
+        # The combined regex finds the interesting lines in the whole buffer, so the lines that don't match
+        # any pattern never become Python objects. Handlers are only called for the matches.
+        handlers = _outputHandlers
+        for m in _outputRegex.finditer(buffer, 0, end):
+            handlers[m.lastgroup](m, self)
+
+    def feed(self, data: bytes):
+        "Parses a chunk of raw tool output that doesn't necessarily end on a line boundary."
+        # The output is parsed without decoding it, only the matched strings are decoded by the handlers.
+        # It's safe to split UTF-8 on the line terminators because they never occur inside multi-byte characters.
+        # Note: progress lines are terminated with '\r' and not '\n'.
+        buffer = self.pendingLine + data
+        end = max(buffer.rfind(b'\n'), buffer.rfind(b'\r')) + 1
+        self.pendingLine = buffer[end:]
+        if end:
+            self.parse(buffer, end)
+
+    def finish(self, command: List[str], returncode: int, stderr: str, elapsedTime: float) -> Result:
+        "Completes the parsing after the tool has exited, raises RuntimeError if it has failed."
+        if self.pendingLine:
+            self.parse(self.pendingLine, len(self.pendingLine))
+            self.pendingLine = b''
+
+        if returncode != 0:
+            lines = b''.join(self.tail).splitlines()[-_STDOUT_TAIL_LINES:]
+            stdout = b''.join(line + b'\n' for line in lines).decode(errors='replace')
+            raise RuntimeError(command, returncode, stdout, stderr)
+
+        if self.compressionRun.learningCurve:
+            self.result.compressionRuns.append(self.compressionRun)
+        self.result.elapsedTime = elapsedTime
+        return self.result
+
+def _parse_base_comp_rate(m, state: _ParserState):
+    state.result.bitsPerPixel = float(m['baseCompRate_bpp'])
+
+def _parse_bpp(m, state: _ParserState):
+    state.result.bitsPerPixel = float(m['bpp_bpp'])
+    state.result.overallPsnr = float(m['bpp_psnr'])
+
+def _parse_bc_quality(m, state: _ParserState):
+    state.result.combinedBcPsnr = float(m['bcQuality_psnr'])
+    state.result.combinedBcBitsPerPixel = float(m['bcQuality_bpp'])
+
+def _parse_cuda_decompression_time(m, state: _ParserState):
+    state.result.decompressionTime = float(m['cudaDecompressionTime_milliseconds'])
+
+def _parse_dimensions(m, state: _ParserState):
+    state.result.dimensions = int(m['dimensions_width']), int(m['dimensions_height'])
+    state.result.channels = int(m['dimensions_channels'])
+    state.result.mipLevels = int(m['dimensions_mipLevels'])
+
+def _parse_experiment(m, state: _ParserState):
+    if state.compressionRun.learningCurve:
+        state.result.compressionRuns.append(state.compressionRun)
+    state.compressionRun = CompressionRun(bitsPerPixel=float(m['experiment_bpp']))
+
+def _parse_file_size(m, state: _ParserState):
+    state.result.savedFileSize = int(m['fileSize_bytes'])
+    state.result.savedFileBpp = float(m['fileSize_bpp'])
+
+def _parse_graphics_decompression_time(m, state: _ParserState):
+    state.result.decompressionTime = float(m['graphicsDecompressionTime_milliseconds'])
+
+def _parse_latent_shape(m, state: _ParserState):
+    state.result.latentShape = LatentShape(gridSizeScale=int(m['latentShape_gss']), highResFeatures=int(m['latentShape_hrf']),
+        lowResFeatures=int(m['latentShape_lrf']), highResQuantBits=int(m['latentShape_hrqb']),
+        lowResQuantBits=int(m['latentShape_lrqb']))
+
+def _parse_mip(m, state: _ParserState):
+    state.result.perMipPsnr.append(float(m['mip_psnr']))
+
+def _parse_network_version(m, state: _ParserState):
+    state.result.networkVersion = m['networkVersion_version'].decode()
+
+def _parse_overall_psnr(m, state: _ParserState):
+    if m['overallPsnr_type'] == b'FP8':
+        state.result.overallPsnrFP8 = float(m['overallPsnr_psnr'])
+    else:
+        state.result.overallPsnr = float(m['overallPsnr_psnr'])
+
+def _parse_step(m, state: _ParserState):
+    point = int(m['step_steps']), float(m['step_milliseconds']), float(m['step_psnr'])
+    state.compressionRun.learningCurve.append(point)
+
+def _parse_system(m, state: _ParserState):
+    result = state.result
+    result.gpuName = m['system_gpu'].decode(errors='replace')
+    result.graphicsApi = m['system_api'].decode()
+    result.gpuFeatures = []
+    if m['system_dp4a'] == b'Y': result.gpuFeatures.append('DP4a')
+    if m['system_fp16'] == b'Y': result.gpuFeatures.append('FP16')
+    if m['system_coopVecInt8'] == b'Y': result.gpuFeatures.append('CoopVecInt8')
+    if m['system_coopVecFP8'] == b'Y': result.gpuFeatures.append('CoopVecFP8')
+
+# Patterns for the lines of ntc-cli output that we're interested in, with their handlers.
+# The output is matched as bytes, so the handlers get bytes groups: float() and int() accept those directly,
+# and the few string values are decoded explicitly.
+# All patterns are merged into a single regex, so the group names are prefixed with the pattern name to keep them unique.
+# The regex is applied to whole blocks of output, so no pattern may match a line terminator: wildcards are limited
+# to character classes that exclude them, and lazy where they could otherwise backtrack over a long line.
+_outputPatterns = [
+    ('baseCompRate', r'Base compression rate: --bitsPerPixel (?P<baseCompRate_bpp>[0-9\.]+)', _parse_base_comp_rate),
+    ('bpp', r'Selected compression rate: (?P<bpp_bpp>[0-9\.]+) bpp, (?P<bpp_psnr>[0-9\.]+|inf) dB PSNR', _parse_bpp),
+    ('bcQuality', r'Combined BCn PSNR: (?P<bcQuality_psnr>[0-9\.]+|inf) dB, bit rate: (?P<bcQuality_bpp>[0-9\.]+) bpp',
+        _parse_bc_quality),
+    ('cudaDecompressionTime', r'CUDA decompression time: (?P<cudaDecompressionTime_milliseconds>[0-9\.]+) ms',
+        _parse_cuda_decompression_time),
+    ('dimensions', r'Dimensions: (?P<dimensions_width>\d+)x(?P<dimensions_height>\d+), (?P<dimensions_channels>\d+) channels, '
+        r'(?P<dimensions_mipLevels>\d+) mip level\(s\)', _parse_dimensions),
+    ('experiment', r'Experiment (?P<experiment_index>\d+): (?P<experiment_bpp>[0-9\.]+) bpp', _parse_experiment),
+    ('fileSize', r'File size: (?P<fileSize_bytes>\d+) bytes, (?P<fileSize_bpp>[0-9\.]+) bits per pixel', _parse_file_size),
+    ('graphicsDecompressionTime', r'Median decompression time over \d+ iterations: '
+        r'(?P<graphicsDecompressionTime_milliseconds>[0-9\.]+) ms', _parse_graphics_decompression_time),
+    ('latentShape', r'Latent shape: --gridSizeScale (?P<latentShape_gss>\d+) --highResFeatures (?P<latentShape_hrf>\d+) '
+        r'--lowResFeatures (?P<latentShape_lrf>\d+) --highResQuantBits (?P<latentShape_hrqb>\d+) '
+        r'--lowResQuantBits (?P<latentShape_lrqb>\d+)', _parse_latent_shape),
+    ('mip', r'MIP[ \t]+(?P<mip_mipLevel>\d+)[ \t]+PSNR: (?P<mip_psnr>[0-9\.]+|inf) dB', _parse_mip),
+    ('networkVersion', r'Network version: (?P<networkVersion_version>[A-Z_]+)', _parse_network_version),
+    ('overallPsnr', r'Overall PSNR \((?P<overallPsnr_type>\w+) weights\): (?P<overallPsnr_psnr>[0-9\.]+|inf) dB',
+        _parse_overall_psnr),
+    ('step', r'Training: (?P<step_steps>\d+) steps, (?P<step_milliseconds>[0-9\.]+) ms/step, '
+        r'intermediate PSNR: (?P<step_psnr>[0-9\.]+|inf) dB', _parse_step),
+    ('system', r'Using (?P<system_gpu>[^\r\n]+?) with (?P<system_api>\w+) API\. DP4a \[(?P<system_dp4a>[YN])\], '
+        r'FP16 \[(?P<system_fp16>[YN])\], CoopVec-Int8 \[(?P<system_coopVecInt8>[YN])\], '
+        r'CoopVec-FP8 \[(?P<system_coopVecFP8>[YN])\]', _parse_system),
+]
+
+# The combined regex - 'lastgroup' of a match is the name of the pattern that matched.
+# Patterns only match at the start of a line, which may also follow a '\r' for the progress lines.
+_outputRegex = re.compile(('(?m)(?:^|(?<=\r))(?:' +
+    '|'.join(f'(?P<{name}>{pattern})' for name, pattern, _ in _outputPatterns) + ')').encode())
+_outputHandlers = { name: handler for name, _, handler in _outputPatterns }
 
 
 def run(args: Arguments) -> Result:
@@ -249,85 +419,91 @@ def run(args: Arguments) -> Result:
 
     command = args.get_command_line()
 
-    taskStartTime = time.time()
-    output = subprocess.run(command, capture_output=True, text=True)
-    taskEndTime = time.time()
-
-    if output.returncode != 0:
-        raise RuntimeError(command, output.returncode, output.stdout, output.stderr)
-    
-    result = Result(
-        elapsedTime=taskEndTime - taskStartTime,
+    state = _ParserState(Result(
         bitsPerPixel=args.bitsPerPixel # if the tool doesn't give us selected BPP, inherit it from the arguments
-    )
+    ))
 
-    compressionRun = CompressionRun()
-
-    for line in output.stdout.splitlines():
-        if m := _baseCompRateRegex.parse(line):
-            result.bitsPerPixel = float(m.bpp)
+    taskStartTime = time.time()
+    # Leaving the 'with' block closes the pipes and waits for the process, like subprocess.run does.
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=_CLOSE_FDS) as process:
+
+        # Drain stderr on a separate thread so that the tool never blocks on a full stderr pipe
+        # while we're reading its stdout.
+        stderrChunks = []
+        stderrThread = threading.Thread(target=lambda: stderrChunks.append(process.stderr.read()))
+        stderrThread.start()
+
+        # Parse the output while the tool is running. It's read in chunks and not lines because the training
+        # progress lines are terminated with '\r', which binary line iteration doesn't recognize.
+        # If parsing fails or we're interrupted, kill the tool so that it doesn't keep running unattended.
+        try:
+            while data := process.stdout.read1(_READ_CHUNK_SIZE):
+                state.feed(data)
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            stderrThread.join()
+
+        process.wait()
+    taskEndTime = time.time()
 
-        elif m := _bppRegex.parse(line):
-            result.bitsPerPixel = float(m.bpp)
-            result.overallPsnr = float(m.psnr)
+    stderr = b''.join(stderrChunks).decode(errors='replace')
+    return state.finish(command, process.returncode, stderr, taskEndTime - taskStartTime)
 
-        elif m := _bcQualityRegex.parse(line):
-            result.combinedBcPsnr = float(m.psnr)
-            result.combinedBcBitsPerPixel = float(m.bpp)
 
-        elif m := _cudaDecompressionTimeRegex.parse(line):
-            result.decompressionTime = float(m.milliseconds)
+async def _run_async(args: Arguments) -> Result:
+    "Same as run(...) but doesn't block the event loop while the tool is running, used by process_concurrent_tasks."
 
-        elif m := _dimensionsRegex.parse(line):
-            result.dimensions = int(m.width), int(m.height)
-            result.channels = int(m.channels)
-            result.mipLevels = int(m.mipLevels)
+    command = args.get_command_line()
 
-        elif m := _experimentRegex.parse(line):
-            if compressionRun.learningCurve:
-                result.compressionRuns = _create_or_append_list(result.compressionRuns, compressionRun)
-            compressionRun = CompressionRun(bitsPerPixel=float(m.bpp))
+    state = _ParserState(Result(
+        bitsPerPixel=args.bitsPerPixel # if the tool doesn't give us selected BPP, inherit it from the arguments
+    ))
 
-        elif m := _fileSizeRegex.parse(line):
-            result.savedFileSize = int(m.bytes)
-            result.savedFileBpp = float(m.bpp)
+    taskStartTime = time.time()
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE, close_fds=_CLOSE_FDS)
 
-        elif m := _graphicsDecompressionTimeRegex.parse(line):
-            result.decompressionTime = float(m.milliseconds)
+    # Read stderr concurrently with stdout so that the tool never blocks on a full stderr pipe.
+    stderrTask = asyncio.ensure_future(process.stderr.read())
 
-        elif m := _latentShapeRegex.parse(line):
-            result.latentShape = LatentShape(gridSizeScale=int(m.gss), highResFeatures=int(m.hrf),
-                lowResFeatures=int(m.lrf), highResQuantBits=int(m.hrqb), lowResQuantBits=int(m.lrqb))
+    # Parse the output while the tool is running. It's read in chunks and not lines because the training
+    # progress lines are terminated with '\r' and can add up to more than the StreamReader line limit.
+    # If parsing fails or the task is cancelled, kill the tool so that it doesn't keep running unattended.
+    try:
+        while data := await process.stdout.read(_READ_CHUNK_SIZE):
+            state.feed(data)
+    except BaseException:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass # The tool has exited already
+        stderrTask.cancel()
+        await process.wait()
+        raise
+
+    stderr = await stderrTask
+    await process.wait()
+    taskEndTime = time.time()
 
-        elif m := _mipRegex.parse(line):
-            result.perMipPsnr = _create_or_append_list(result.perMipPsnr, float(m.psnr))
+    return state.finish(command, process.returncode, stderr.decode(errors='replace'), taskEndTime - taskStartTime)
 
-        elif m := _networkVersionRegex.parse(line):
-            result.networkVersion = m.version
-            
-        elif m := _overallPsnrRegex.parse(line):
-            if m.type == 'FP8':
-                result.overallPsnrFP8 = float(m.psnr)
-            else:
-                result.overallPsnr = float(m.psnr)
 
-        elif m := _stepRegex.parse(line):
-            tuple = int(m.steps), float(m.milliseconds), float(m.psnr)
-            compressionRun.learningCurve = _create_or_append_list(compressionRun.learningCurve, tuple)
+def _run_event_loop(coroutine):
+    # asyncio.run() refuses to start while another event loop is running on this thread,
+    # run the coroutine on a helper thread with a new event loop in that case.
+    try:
+        asyncio.get_running_loop()
+        loopRunning = True
+    except builtins.RuntimeError: # Not the RuntimeError defined in this module
+        loopRunning = False
 
-        elif m := _systemRegex.parse(line):
-            result.gpuName = m.gpu
-            result.graphicsApi = m.api
-            result.gpuFeatures = []
-            if m.dp4a == 'Y': result.gpuFeatures.append('DP4a')
-            if m.fp16 == 'Y': result.gpuFeatures.append('FP16')
-            if m.coopVecInt8 == 'Y': result.gpuFeatures.append('CoopVecInt8')
-            if m.coopVecFP8 == 'Y': result.gpuFeatures.append('CoopVecFP8')
-        
-    if compressionRun.learningCurve:
-        result.compressionRuns = _create_or_append_list(result.compressionRuns, compressionRun)
+    if not loopRunning:
+        return asyncio.run(coroutine)
 
-    return result
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
 
 
 def process_concurrent_tasks(tasks: List[Any], devices: List[int], ready: Callable) -> bool:
@@ -335,6 +511,9 @@ def process_concurrent_tasks(tasks: List[Any], devices: List[int], ready: Callab
     Executes the tasks from the list on one or more GPUs concurrently.
     The 0-based indices of CUDA devices are provided in the 'devices' argument.
 
+    Every task is executed as a separate ntc-cli process, because the tool processes one texture set
+    per invocation. Each device runs one process at a time.
+
     The 'tasks' argument is a list of tasks, where each task may be either an Arguments instance,
     or a tuple (Arguments, ...).
 
@@ -344,11 +523,12 @@ def process_concurrent_tasks(tasks: List[Any], devices: List[int], ready: Callab
         def ready(task, result: ntc.Result, originalTaskCount: int, tasksCompleted: int):
 
     The 'task' argument to 'ready' is the original task from the input list,
-    which may be Arguments or tuple. The 'ready' function is called from the worker threads,
-    but under a mutex, so only one call at a time.
+    which may be Arguments or tuple. The 'ready' function is called from the thread that called
+    process_concurrent_tasks, one call at a time. If that thread already runs an asyncio event loop,
+    such as in a Jupyter kernel, the tasks run on a helper thread with its own event loop instead,
+    and 'ready' is called from that helper thread; process_concurrent_tasks still blocks until all tasks are done.
     """
 
-    mutex = threading.Lock()
     terminate = False
     originalTaskCount = len(tasks)
     tasksCompleted = 0
@@ -358,55 +538,52 @@ def process_concurrent_tasks(tasks: List[Any], devices: List[int], ready: Callab
         terminate = True
         print('\nSIGINT received, stopping.', file=sys.stderr)
 
-    def _thread_function(device):
-        nonlocal terminate
+    async def _process_task(task, device: int):
+        nonlocal terminate, tasksCompleted
 
-        while not terminate:
-            # Take the next task from the list
-            task = None
-            with mutex:
-                if len(tasks) > 0:
-                    task = tasks[0]
-                    del tasks[0]
-            if task is None:
-                break
-
-            # Extract the Arguments from the task
-            args : Arguments = task[0] if isinstance(task, Tuple) else task
-            assert isinstance(args, Arguments)
-    
-            # Add the device argument to the command.
-            args.cudaDevice = device
-
-            # Run the task
-            try:
-                result = run(args)
-            except Exception as e:
-                if isinstance(e, RuntimeError):
-                    if not terminate:
-                        print(f'\nNTC error: {e}', file=sys.stderr)
-                else:
-                    traceback.print_exception(e, file=sys.stderr)
-                terminate = True
-                return
-            
-            # Call the ready function
-            with mutex:
-                nonlocal tasksCompleted
-                tasksCompleted += 1
-
-                try:
-                    ready(task, result, originalTaskCount, tasksCompleted)
-                except Exception as e:
-                    print('\nError in the "ready" callback:')
-                    traceback.print_exception(e, file=sys.stderr)
-                    terminate = True
-                    return
-
-
-    # Validate the tasks before starting threads
+        # Extract the Arguments from the task
+        args : Arguments = task[0] if isinstance(task, tuple) else task
+        assert isinstance(args, Arguments)
+
+        # Add the device argument to the command.
+        args.cudaDevice = device
+
+        # Run the task
+        try:
+            result = await _run_async(args)
+        except Exception as e:
+            if isinstance(e, RuntimeError):
+                if not terminate:
+                    print(f'\nNTC error: {e}', file=sys.stderr)
+            else:
+                traceback.print_exception(e, file=sys.stderr)
+            terminate = True
+            return
+
+        # Call the ready function. All tasks run on the same event loop thread, so only one call at a time.
+        tasksCompleted += 1
+        try:
+            ready(task, result, originalTaskCount, tasksCompleted)
+        except Exception as e:
+            print('\nError in the "ready" callback:')
+            traceback.print_exception(e, file=sys.stderr)
+            terminate = True
+
+    async def _device_worker(device: int, pendingTasks: deque):
+        # Take the tasks in their original order until there are none left.
+        # Tasks that haven't started before termination are skipped.
+        while pendingTasks and not terminate:
+            await _process_task(pendingTasks.popleft(), device)
+
+    async def _process_all_tasks():
+        # One worker per device, sharing the queue of pending tasks. The workers run on the same event loop thread,
+        # so the deque needs no locking.
+        pendingTasks = deque(tasks)
+        await asyncio.gather(*(_device_worker(device, pendingTasks) for device in devices))
+
+    # Validate the tasks before starting the event loop
     for task in tasks:
-        if isinstance(task, Tuple):
+        if isinstance(task, tuple):
             if not isinstance(task[0], Arguments):
                 raise ValueError(f'Task {task} is a tuple but its first member is not Arguments')
         elif not isinstance(task, Arguments):
@@ -417,16 +594,8 @@ def process_concurrent_tasks(tasks: List[Any], devices: List[int], ready: Callab
         old_handler = signal.getsignal(signal.SIGINT)
         signal.signal(signal.SIGINT, _sigint_handler)
 
-        # Launch worker threads, one per device
-        threads = []
-        for device in devices:
-            thread = threading.Thread(target = _thread_function, args = [device])
-            thread.start()
-            threads.append(thread)
-            
-        # Wait for all threads to finish
-        for thread in threads:
-            thread.join()
+        # Run the tasks on an event loop, with one ntc-cli process per device at a time
+        _run_event_loop(_process_all_tasks())
     finally:
         signal.signal(signal.SIGINT, old_handler)
 
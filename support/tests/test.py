@@ -14,6 +14,9 @@ import unittest
 import os
 import sys
 import shutil
+import concurrent.futures
+import functools
+import math
 import numpy
 from PIL import Image
 
@@ -24,6 +27,12 @@ try:
 except ImportError:
     _OPEN_EXR_SUPPORTED = False
 
+try:
+    import numba
+    _NUMBA_SUPPORTED = True
+except ImportError:
+    _NUMBA_SUPPORTED = False
+
 _DP4A_SUPPORTED = False
 _FP16_SUPPORTED = False
 _COOPVEC_INT8_SUPPORTED = False
@@ -55,7 +64,7 @@ scratchDir = os.path.join(sdkroot, 'assets/testscratch')
 
 def _loadPillowImage(filename):
     image = Image.open(filename)
-    return numpy.array(image, dtype=numpy.int16) # Convert to signed int so that (a-b) operation works both ways
+    return numpy.asarray(image) # Keep the original 8-bit data, _computeMSE widens it
 
 def _loadExrImage(filename):
     assert _OPEN_EXR_SUPPORTED
@@ -67,15 +76,52 @@ def _loadExrImage(filename):
     height = dataWindow.max.y - dataWindow.min.y + 1
     channels = header['channels']
     numChannels = len(channels)
-    
-    data = numpy.zeros(shape=(width, height, numChannels), dtype=numpy.float32)
 
-    for ch in range(numChannels):
-        channelBytes = image.channel('RGBA'[ch], pixel_type=Imath.PixelType(Imath.PixelType.FLOAT))
-        channelArray = numpy.frombuffer(channelBytes, dtype=numpy.float32)
-        data[:, :, ch] = channelArray.reshape((width, height))
-
-    return data
+    # Read all channels in one call. Each channel is stored as 'height' rows of 'width' pixels,
+    # so the planar data is (channel, y, x) and gets transposed into (y, x, channel) like Pillow images.
+    channelBytes = image.channels(list('RGBA'[:numChannels]), Imath.PixelType(Imath.PixelType.FLOAT))
+    data = numpy.frombuffer(b''.join(channelBytes), dtype=numpy.float32)
+
+    return data.reshape((numChannels, height, width)).transpose(1, 2, 0)
+
+if _NUMBA_SUPPORTED:
+    @numba.njit(parallel=True, cache=True)
+    def _computeMSE(arr1, arr2):
+        # Fused subtract, square and sum in one pass over both images, without the temporary arrays.
+        # Rows are summed in parallel, then the per-row sums are added up in a fixed order.
+        height, width, channels = arr1.shape
+        rowSums = numpy.zeros(height)
+        for y in numba.prange(height):
+            rowSum = 0.0
+            for x in range(width):
+                for c in range(channels):
+                    d = float(arr1[y, x, c]) - float(arr2[y, x, c])
+                    rowSum += d * d
+            rowSums[y] = rowSum
+        return rowSums.sum() / arr1.size
+else:
+    def _computeMSE(arr1, arr2):
+        # Subtract in a signed type that is wide enough for the squares of 8-bit differences
+        diff = numpy.subtract(arr1, arr2, dtype=numpy.promote_types(numpy.result_type(arr1, arr2), numpy.int32))
+        return numpy.mean(diff * diff)
+
+@functools.lru_cache(maxsize=None)
+def _warmUpMSE():
+    # Numba compiles _computeMSE separately for every combination of element type, memory layout and writeability
+    # of the arguments. Compile the combinations that the tests use up front, so that the first PSNR comparison
+    # in a test doesn't include the compilation time. The loaded images are all read-only: Pillow and frombuffer
+    # return read-only arrays. 8-bit images are contiguous or sliced to fewer channels, EXR images are transposed.
+    def readOnly(array):
+        array.flags.writeable = False
+        return array
+
+    ldrReference = readOnly(numpy.zeros((2, 2, 3), numpy.uint8))
+    ldrImage = readOnly(numpy.zeros((2, 2, 4), numpy.uint8))
+    _computeMSE(ldrReference, ldrImage[:, :, :3])
+    _computeMSE(ldrReference, ldrReference)
+
+    hdrImage = readOnly(numpy.zeros((3, 2, 2), numpy.float32)).transpose(1, 2, 0)
+    _computeMSE(hdrImage, hdrImage)
 
 def _loadAutoImage(filename: str):
     if filename.lower().endswith('.exr'):
@@ -83,51 +129,62 @@ def _loadAutoImage(filename: str):
     else:
         return _loadPillowImage(filename)
 
+@functools.lru_cache(maxsize=32)
+def _loadReferenceImage(filename: str):
+    # The source images are the same for all decompression tests, decode them only once.
+    # The cached arrays are shared, so make sure that nobody modifies them.
+    image = _loadAutoImage(filename)
+    image.flags.writeable = False
+    return image
+
 
 class TestCase(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        cls.prepareScratch()
+        if _NUMBA_SUPPORTED:
+            _warmUpMSE()
+
     def setUp(self):
         self.tool = ntc.get_default_tool_path()
-        self.prepareScratch()
 
-    def prepareScratch(self):
+    @staticmethod
+    def prepareScratch():
         if os.path.exists(scratchDir):
             shutil.rmtree(scratchDir)
         os.makedirs(scratchDir)
 
     def computePSNR(self, img_path1, img_path2, ignoreExtraChannels, hdr=False):
-        "Loads two common format image files and returns PSNR between them in dB"
-        
-        # Load the images
-        arr1 = _loadAutoImage(img_path1)
-        arr2 = _loadAutoImage(img_path2)
+        "Loads two common format image files and returns PSNR between them in dB, the first one is the reference"
+        return self.computeImagePSNR(_loadReferenceImage(img_path1), _loadAutoImage(img_path2), ignoreExtraChannels, hdr)
+
+    def computeImagePSNR(self, arr1, arr2, ignoreExtraChannels, hdr=False):
+        "Returns PSNR between two images loaded with _loadAutoImage in dB"
 
         # Ensure both images have the same dimensions
         self.assertEqual(arr1.shape[0:2], arr2.shape[0:2])
 
-        if len(arr1.shape) == 2: arr1 = numpy.expand_dims(arr1, 2)
-        if len(arr2.shape) == 2: arr2 = numpy.expand_dims(arr2, 2)
+        if len(arr1.shape) == 2: arr1 = arr1[..., None]
+        if len(arr2.shape) == 2: arr2 = arr2[..., None]
 
         # Ensure that image2 has the same or greter number of channels
         if ignoreExtraChannels:
             self.assertGreaterEqual(arr2.shape[2], arr1.shape[2])
-            # Delete the extra channels from arr2, if any
-            arr2 = numpy.delete(arr2, range(arr1.shape[2], arr2.shape[2]), 2)
+            # Drop the extra channels from arr2, if any. This is a view, _computeMSE handles any strides.
+            arr2 = arr2[:, :, :arr1.shape[2]]
         else:
             self.assertEqual(arr2.shape[2], arr1.shape[2])
 
         # Compute mean squared error (MSE) between the two images
-        mse = numpy.mean((arr1 - arr2) ** 2)
-
-        # Compute PSNR from MSE, assuming that image data is in 0-255 integers
-        psnr = 10 * numpy.log10(255**2 / mse)
+        mse = float(_computeMSE(arr1, arr2))
+        if mse == 0:
+            return math.inf
 
-        return psnr
+        # Compute PSNR from MSE. LDR image data is in 0-255 integers, for HDR data use the peak of the reference image.
+        peak = float(arr1.max()) if hdr else 255.0
+        return 20 * math.log10(peak) - 10 * math.log10(mse)
 
-    def assertFileExists(self, path):
-        if not os.path.exists(path):
-            raise self.failureException(f"'{path}' does not exist")
-        
     def assertBetween(self, value, low, high):
         if value < low or value > high:
             raise self.failureException(f'{value} is not between {low} and {high}')
@@ -143,18 +200,28 @@ class TestCase(unittest.TestCase):
             'Roughness'
         ]
 
-        for name, expectedPsnr in zip(imageNames, expectedPsnrValues):
-            originalImageFileName = os.path.join(sourceDir, f'{name}.jpg')
-            decompressedImageFileName = os.path.join(decompressedDir, f'{name}.tga')
+        originalImageFileNames = [os.path.join(sourceDir, f'{name}.jpg') for name in imageNames]
+        decompressedImageFileNames = [os.path.join(decompressedDir, f'{name}.tga') for name in imageNames]
+
+        # Decode all images concurrently, the decoders release the GIL. The PSNR is computed on this thread
+        # in the original order because the Numba kernel is parallel already, and so that the asserts stay here.
+        # Missing files are reported when the decoder fails to open them, there's no separate existence check.
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            originalImages = executor.map(_loadReferenceImage, originalImageFileNames)
+            decompressedImages = executor.map(_loadAutoImage, decompressedImageFileNames)
 
-            self.assertFileExists(decompressedImageFileName)
+            try:
+                for name, expectedPsnr, originalImage, decompressedImage in zip(imageNames, expectedPsnrValues,
+                    originalImages, decompressedImages):
 
-            psnr = self.computePSNR(originalImageFileName, decompressedImageFileName, ignoreExtraChannels)
+                    psnr = self.computeImagePSNR(originalImage, decompressedImage, ignoreExtraChannels)
 
-            if expectedPsnr > 0:
-                self.assertBetween(psnr, expectedPsnr - toleranceDb, expectedPsnr + toleranceDb)
-            else:
-                print(f'{name}: actual PSNR = {psnr:.2f} dB')
+                    if expectedPsnr > 0:
+                        self.assertBetween(psnr, expectedPsnr - toleranceDb, expectedPsnr + toleranceDb)
+                    else:
+                        print(f'{name}: actual PSNR = {psnr:.2f} dB')
+            except FileNotFoundError as e:
+                raise self.failureException(f"'{e.filename}' does not exist")
 
 class DescribeTestCase(TestCase):
 
@@ -290,32 +357,42 @@ class HdrCompressionTestCase(TestCase):
 
 class DecompressionTestCase(TestCase):
 
-    def __init__(self, api: str, networkVersion: str, featureLevel: int) -> None:
-        super().__init__()
-        self.api = api
-        self.networkVersion = networkVersion
-        self.featureLevel = featureLevel
-
     def __str__(self):
-        return f'Decompression ({self.api}, {self.networkVersion} network, {FL_STRINGS[self.featureLevel]})'
+        return 'Decompression'
 
     def runTest(self):
-        if self.api == 'dx12' and os.name != 'nt':
+        # All combinations run as subtests of one test case, so they share the scratch directory setup
+        # and each combination is still reported separately.
+        for api in ('cuda', 'vk', 'dx12'):
+            for networkVersion in ('small', 'medium', 'large', 'xlarge'):
+                if api == 'cuda':
+                    featureLevels = (FL_LEGACY,)
+                else:
+                    featureLevels = (FL_LEGACY, FL_DP4A, FL_FP16, FL_COOPVEC_INT8, FL_COOPVEC_FP8)
+                for featureLevel in featureLevels:
+                    with self.subTest(api=api, networkVersion=networkVersion, featureLevel=FL_STRINGS[featureLevel]):
+                        self.runDecompression(api, networkVersion, featureLevel)
+
+    def runDecompression(self, api: str, networkVersion: str, featureLevel: int):
+        if api == 'dx12' and os.name != 'nt':
             self.skipTest('DX12 is only available on Windows')
-        if self.featureLevel >= FL_DP4A and not _DP4A_SUPPORTED:
+        if featureLevel >= FL_DP4A and not _DP4A_SUPPORTED:
             self.skipTest('DP4a is not supported')
-        if self.featureLevel >= FL_FP16 and not _FP16_SUPPORTED:
+        if featureLevel >= FL_FP16 and not _FP16_SUPPORTED:
             self.skipTest('FP16 is not supported')
-        if self.featureLevel >= FL_COOPVEC_INT8 and not _COOPVEC_INT8_SUPPORTED:
+        if featureLevel >= FL_COOPVEC_INT8 and not _COOPVEC_INT8_SUPPORTED:
             self.skipTest('CoopVec-Int8 is not supported')
-        if self.featureLevel >= FL_COOPVEC_FP8 and not _COOPVEC_FP8_SUPPORTED:
+        if featureLevel >= FL_COOPVEC_FP8 and not _COOPVEC_FP8_SUPPORTED:
             self.skipTest('CoopVec-FP8 is not supported')
         
         sourceMaterialDir = os.path.join(sourceDir, 'PavingStones070')
-        ntcFileName = os.path.join(testFilesDir, f'PavingStones070_4bpp_{self.networkVersion}.ntc')
+        ntcFileName = os.path.join(testFilesDir, f'PavingStones070_4bpp_{networkVersion}.ntc')
         decompressedDir = os.path.join(scratchDir, 'output')
+
+        # Remove the previous subtest's images so that a failed decompression can't be compared against them
+        shutil.rmtree(decompressedDir, ignore_errors=True)
     
-        isCuda = self.api == 'cuda'
+        isCuda = api == 'cuda'
 
         args = ntc.Arguments(
             tool=self.tool,
@@ -324,25 +401,25 @@ class DecompressionTestCase(TestCase):
             saveImages=decompressedDir,
             imageFormat='tga',
             bcFormat='none',
-            graphicsApi='' if isCuda else self.api
+            graphicsApi='' if isCuda else api
         )
 
         if not isCuda:
-            args.noDP4a = self.featureLevel < FL_DP4A
-            args.noFloat16 = self.featureLevel < FL_FP16
-            args.noCoopVecInt8 = self.featureLevel != FL_COOPVEC_INT8
-            args.noCoopVecFP8 = self.featureLevel != FL_COOPVEC_FP8
+            args.noDP4a = featureLevel < FL_DP4A
+            args.noFloat16 = featureLevel < FL_FP16
+            args.noCoopVecInt8 = featureLevel != FL_COOPVEC_INT8
+            args.noCoopVecFP8 = featureLevel != FL_COOPVEC_FP8
 
         result = ntc.run(args)
         
         if isCuda:
             self.assertEqual(result.graphicsApi, '')
-        elif self.api == 'vk':
+        elif api == 'vk':
             self.assertEqual(result.graphicsApi, 'Vulkan')
-        elif self.api == 'dx12':
+        elif api == 'dx12':
             self.assertEqual(result.graphicsApi, 'D3D12')
         
-        if self.networkVersion in ('small', 'medium'):
+        if networkVersion in ('small', 'medium'):
             expectedPsnr = (33.8, 29.8, 40.3, 29.6, 36.1)
         else:
             expectedPsnr = (34.3, 30.4, 40.4, 29.5, 35.8)
@@ -356,14 +433,7 @@ if __name__ == '__main__':
     suite.addTest(DescribeTestCase())
     suite.addTest(CompressionTestCase())
     suite.addTest(HdrCompressionTestCase())
-
-    for api in ('cuda', 'vk', 'dx12'):
-        for networkVersion in ('small', 'medium', 'large', 'xlarge'):
-            if api == 'cuda':
-                suite.addTest(DecompressionTestCase(api=api, networkVersion=networkVersion, featureLevel=FL_LEGACY))
-            else:
-                for featureLevel in (FL_LEGACY, FL_DP4A, FL_FP16, FL_COOPVEC_INT8, FL_COOPVEC_FP8):
-                    suite.addTest(DecompressionTestCase(api=api, networkVersion=networkVersion, featureLevel=featureLevel))
+    suite.addTest(DecompressionTestCase())
 
     runner = unittest.TextTestRunner(verbosity=2)
     runner.run(suite)
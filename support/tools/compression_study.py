@@ -11,6 +11,7 @@
 # its affiliates is strictly prohibited.
 
 import argparse
+import copy
 import os
 import sys
 import time
@@ -71,9 +72,9 @@ materialFilter = None
 if args.filter is not None:
     if args.filter.startswith('@'):
         with open(args.filter[1:], 'r') as file:
-            materialFilter = [s.strip() for s in file.readlines()]
+            materialFilter = frozenset(s.strip() for s in file.readlines())
     else:
-        materialFilter = args.filter.split(',')
+        materialFilter = frozenset(args.filter.split(','))
 
 targetMipCount = 13
 
@@ -82,25 +83,40 @@ if args.output is not None:
 else:
     outputFile = sys.stdout
 
-outputFile.write('Name,Experiment,')
+headerCells = ['Name', 'Experiment']
 if args.mips:
-    for mip in range(targetMipCount):
-        outputFile.write(f'MIP {mip},')
+    headerCells += (f'MIP {mip}' for mip in range(targetMipCount))
 elif args.curve:
-    for step in range(args.stepsPerIteration, args.trainingSteps + 1, args.stepsPerIteration):
-        outputFile.write(f'{step},')
-    outputFile.write('Final')
+    headerCells += (f'{step}' for step in range(args.stepsPerIteration, args.trainingSteps + 1, args.stepsPerIteration))
+    headerCells.append('Final')
 else:
-    outputFile.write('PSNR')
-outputFile.write(',BPP')
-outputFile.write(',Time(s)')
-outputFile.write('\n')
-
+    headerCells.append('PSNR')
+headerCells += ['BPP', 'Time(s)']
+outputFile.write(','.join(headerCells) + '\n')
+
+
+# The arguments are the same for all materials in an experiment except the path,
+# so build them once per experiment and copy for each material.
+experimentTemplates = []
+for (experimentName, parameters) in experiments:
+    experimentArgs = ntc.Arguments(tool=args.tool, **parameters)
+    experimentArgs.generateMips = args.mips
+    experimentArgs.compress = True
+    experimentArgs.decompress = True
+    experimentArgs.trainingSteps = args.trainingSteps
+    experimentArgs.stepsPerIteration = args.stepsPerIteration
+    apply_common_settings(experimentArgs)
+    experimentTemplates.append((experimentName, experimentArgs))
 
 ordinal = 0
 count = 0
 tasks = []
+datasetPrefixLength = len(args.dataset) + 1
 for (dirname, subdirs, files) in os.walk(args.dataset):
+    # Visit the subdirectories in sorted order so that --skip, --stride and --limit select the same materials
+    # on every run, os.walk returns them in the file system order.
+    subdirs.sort()
+
     # We only want directories that contain image files and no other subdirectories
     if len(files) == 0 or len(subdirs) != 0:
         continue
@@ -111,27 +127,24 @@ for (dirname, subdirs, files) in os.walk(args.dataset):
     if args.skip and (ordinal < args.skip):
         continue
 
-    shortDirname = dirname[len(args.dataset)+1:] if dirname.startswith(args.dataset) else dirname
-    if args.filter is not None and shortDirname not in materialFilter:
+    shortDirname = dirname[datasetPrefixLength:] if dirname.startswith(args.dataset) else dirname
+    if materialFilter is not None and shortDirname not in materialFilter:
         continue
 
-    for (experimentName, parameters) in experiments:
-        task = ntc.Arguments(tool=args.tool)
-        task.__dict__.update(parameters)
+    for (experimentName, experimentArgs) in experimentTemplates:
+        task = copy.copy(experimentArgs)
         task.loadImages = dirname
-        task.generateMips = args.mips
-        task.compress = True
-        task.decompress = True
-        task.trainingSteps = args.trainingSteps
-        task.stepsPerIteration = args.stepsPerIteration
-        apply_common_settings(task)
         tasks.append((task, shortDirname, experimentName))
 
     count += 1
     if args.limit and count >= args.limit:
         break
 
-startTime = time.time()
+startTime = time.monotonic()
+
+# Progress is printed at most this often, in seconds, plus once when the last task completes
+progressInterval = 0.25
+lastProgressTime = 0.0
 
 def FormatDuration(seconds):
     seconds = int(seconds)
@@ -141,31 +154,33 @@ def FormatDuration(seconds):
 
 
 def task_ready(task, result: ntc.Result, originalTaskCount: int, completedTaskCount: int):
+    global lastProgressTime
     ntcArgs, shortDirname, experimentName = task
 
-    outputFile.write(f'{shortDirname},{experimentName},')
+    # Build the whole row first and write it at once
+    cells = [shortDirname, experimentName]
 
     if args.mips:
-        for mip in range(targetMipCount):
-            if result.perMipPsnr is not None and mip < len(result.perMipPsnr):
-                psnr = result.perMipPsnr[mip]
-            else:
-                psnr = ''
-            outputFile.write(f'{psnr},')
+        cells += (f'{psnr}' for psnr in result.perMipPsnr[:targetMipCount])
+        cells += [''] * (targetMipCount - len(result.perMipPsnr))
     elif args.curve:
         run = result.compressionRuns[0]
-        for psnr in result.compressionRuns:
-            outputFile.write(f'{psnr},')
-        outputFile.write(f'{result.overallPsnr}')
+        cells += (f'{psnr}' for steps, millisecondsPerStep, psnr in run.learningCurve)
+        cells.append(f'{result.overallPsnr}')
     else:
-        outputFile.write(f'{result.overallPsnr}')
+        cells.append(f'{result.overallPsnr}')
 
-    outputFile.write(f',{result.bitsPerPixel or ""}')
-    outputFile.write(f',{result.elapsedTime:.2f}')
-    outputFile.write('\n')
+    cells.append(f'{result.bitsPerPixel or ""}')
+    cells.append(f'{result.elapsedTime:.2f}')
+    outputFile.write(','.join(cells) + '\n')
 
     if args.output is not None:
-        elapsedTime = time.time() - startTime
+        now = time.monotonic()
+        if now - lastProgressTime < progressInterval and completedTaskCount != originalTaskCount:
+            return
+        lastProgressTime = now
+
+        elapsedTime = now - startTime
         eta = (originalTaskCount - completedTaskCount) * elapsedTime / float(completedTaskCount)
         etaString = FormatDuration(eta)
 
@@ -11,20 +11,28 @@
 # its affiliates is strictly prohibited.
 
 import argparse
-import copy
+import functools
+import hashlib
 import json
 import os
 import PIL
 import PIL.Image
 import sys
-from dataclasses import dataclass
-from typing import Optional, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any, Tuple
 
 # add ../../libraries to the path to import ntc
 sdkroot = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 sys.path.append(os.path.join(sdkroot, 'libraries'))
 import ntc
 
+try:
+    import orjson
+    _ORJSON_SUPPORTED = True
+except ImportError:
+    _ORJSON_SUPPORTED = False
+
 defaultTool = ntc.get_default_tool_path()
 
 parser = argparse.ArgumentParser()
@@ -63,6 +71,10 @@ class TextureParams:
     semantics: dict
     bcFormat: str
     sRGB: bool = False
+    gltfPathParts: Tuple[str, ...] = field(init=False) # gltfPath split into node names, see get_node_by_path
+
+    def __post_init__(self):
+        self.gltfPathParts = tuple(self.gltfPath.split('/'))
 
 textureTypes = [
     TextureParams(
@@ -126,13 +138,91 @@ def get_file_basename(fileName):
 def get_file_stem(fileName):
     return os.path.splitext(get_file_basename(fileName))[0]
 
+@functools.lru_cache(maxsize=None)
+def get_directory_file_names(dirName):
+    # Names of the files in a directory, normalized for case-insensitive file systems.
+    # Cached because the textures of a model are usually stored in a few directories.
+    try:
+        with os.scandir(dirName or '.') as entries:
+            return frozenset(os.path.normcase(entry.name) for entry in entries if entry.is_file())
+    except OSError:
+        return frozenset()
+
+def file_exists(fileName):
+    # Uses the cached directory listing instead of a file system query for every texture.
+    # Names that are not in the listing are checked on the file system, which finds files on case-insensitive
+    # mounts on POSIX, where normcase doesn't change the case, and files created after the directory was listed.
+    dirName, baseName = os.path.split(fileName)
+    return os.path.normcase(baseName) in get_directory_file_names(dirName) or os.path.exists(fileName)
+
+@functools.lru_cache(maxsize=None)
+def get_relative_path(path, start):
+    # os.path.relpath makes both paths absolute and compares them component by component,
+    # cache it because the same image paths are made relative to the output directory for many materials
+    return os.path.relpath(path, start)
+
+@functools.lru_cache(maxsize=None)
+def get_image_channel_count(fileName):
+    # Opening the image only reads its header, not the pixels. The result is cached because the same images
+    # are often used by many materials.
+    with PIL.Image.open(fileName) as img:
+        return len(img.getbands())
+
+@functools.lru_cache(maxsize=None)
+def find_image_file(imageUri):
+    # Returns the name of the image file to use for compression, or None if there is no such file.
+    # DDS images are replaced with an image of the same name in a format that the compressor can read.
+    # Cached because many materials reference the same images.
+    if imageUri.endswith('.dds'):
+        for ext in ('.png', '.jpg', '.jpeg', '.tga', '.bmp'):
+            newUri = os.path.splitext(imageUri)[0] + ext
+            if file_exists(newUri):
+                return newUri
+        return None
+    return imageUri if file_exists(imageUri) else None
+
 @dataclass
 class ManifestState:
     textures: List[Dict[str, Any]]
     numChannels: int = 0
 
-def get_node_by_path(root, path):
-    for part in path.split('/'):
+def load_json_file(fileName):
+    # orjson parses large GLTF files several times faster than the json module, use it when it's installed
+    if _ORJSON_SUPPORTED:
+        with open(fileName, 'rb') as file:
+            return orjson.loads(file.read())
+    with open(fileName, 'r') as file:
+        return json.load(file)
+
+def save_manifest_file(fileName, manifest):
+    if _ORJSON_SUPPORTED:
+        with open(fileName, 'wb') as file:
+            file.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+    else:
+        # Serialize the whole manifest first, json.dump would issue a write for every token
+        with open(fileName, 'w') as file:
+            file.write(json.dumps(manifest, indent=2))
+
+def save_gltf_file(fileName, gltf):
+    # orjson only supports 2-space indentation and writes UTF-8, match that in the json module fallback
+    # so that the output doesn't depend on which module is installed
+    if _ORJSON_SUPPORTED:
+        with open(fileName, 'wb') as file:
+            file.write(orjson.dumps(gltf, option=orjson.OPT_INDENT_2))
+    else:
+        with open(fileName, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(gltf, indent=2, ensure_ascii=False))
+
+def get_manifest_hash(manifestTextures):
+    # Digest of the canonical serialization of the manifest textures: materials with equal textures get equal hashes
+    if _ORJSON_SUPPORTED:
+        data = orjson.dumps(manifestTextures, option=orjson.OPT_SORT_KEYS)
+    else:
+        data = json.dumps(manifestTextures, sort_keys=True).encode()
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def get_node_by_path(root, pathParts):
+    for part in pathParts:
         root = root.get(part, None)
         if root is None:
             return None
@@ -140,7 +230,7 @@ def get_node_by_path(root, path):
 
 def add_texture_to_manifest(material, manifest: ManifestState, texture: TextureParams, texturesNode, imagesNode, newImageIndex,
                             gltfDir, manifestDir):
-    materialTextureNode = get_node_by_path(material, texture.gltfPath)
+    materialTextureNode = get_node_by_path(material, texture.gltfPathParts)
     if materialTextureNode is None:
         return
     textureIndex = materialTextureNode['index']
@@ -156,24 +246,18 @@ def add_texture_to_manifest(material, manifest: ManifestState, texture: TextureP
         return
 
     imageUri = os.path.join(gltfDir, imageUri)
-    if (imageUri.endswith('.dds')):
-        foundReplacement = False
-        for ext in ('.png', 'jpg', '.jpeg', '.tga', '.bmp'):
-            newUri = os.path.splitext(imageUri)[0] + ext
-            if os.path.exists(newUri):
-                imageUri = newUri
-                foundReplacement = True
-                break
-        if not foundReplacement:
+    imageFile = find_image_file(imageUri)
+    if imageFile is None:
+        if imageUri.endswith('.dds'):
             print(f'  WARNING: Couldn\'t find a non-DDS replacement for {imageUri}, skipping.')
-            return
-    elif not os.path.exists(imageUri):
-        print(f'  WARNING: {imageUri} does not exist, skipping.')
+        else:
+            print(f'  WARNING: {imageUri} does not exist, skipping.')
         return
+    imageUri = imageFile
     
     print(f'  {texture.name}: {get_file_basename(imageUri)}')
     
-    imagePathRelativeToManifest = os.path.relpath(imageUri, manifestDir)
+    imagePathRelativeToManifest = get_relative_path(imageUri, manifestDir)
 
     if texture.name == 'Occlusion':
         # Try to merge the occlusion texture slice with a previously created roughness-metalness slice
@@ -194,7 +278,7 @@ def add_texture_to_manifest(material, manifest: ManifestState, texture: TextureP
         'newTextureIndex': newTextureIndex # Store this temporarily for texture merging, deleted later
     }
 
-    semantics = copy.deepcopy(texture.semantics)
+    semantics = texture.semantics.copy()
 
     # Find the name of the semantic that uses the Alpha channel, if any
     alphaSemantic = None
@@ -203,13 +287,12 @@ def add_texture_to_manifest(material, manifest: ManifestState, texture: TextureP
             alphaSemantic = name
 
     # Get the number of channels in the original image
-    with PIL.Image.open(imageUri) as img:
-        numChannels = len(img.getbands())
-        # If there is such semantic, see if the image has an alpha channel.
-        # Delete the semantic if there is no alpha channel.
-        if numChannels < 4 and alphaSemantic is not None:
-            del semantics[alphaSemantic]
+    numChannels = get_image_channel_count(imageUri)
 
+    # If there is such semantic, see if the image has an alpha channel.
+    # Delete the semantic if there is no alpha channel.
+    if numChannels < 4 and alphaSemantic is not None:
+        del semantics[alphaSemantic]
     
     manifestEntry['semantics'] = semantics
     
@@ -254,20 +337,38 @@ class MaterialDefinition:
     materialName: str
     materialIndexInModel: int
     manifestTextures: List[Dict[str, Any]]
+    manifestHash: bytes = b''
     references: Optional["MaterialDefinition"] = None
     manifestFileName: str = None
     ntcFileName: str = None
     newImageNode: Any = None
 
-materialDefinitions : List[MaterialDefinition] = []
-materialCountsPerModel : Dict[str, int] = {}
+def prefetch_image_channel_counts(materialsNode, texturesNode, imagesNode, gltfDir):
+    # Read the headers of all images used by the materials on a thread pool, which fills the channel count cache
+    # before the materials are processed. Most of the time is spent waiting for the file system, so this scales
+    # well with threads. Any errors are ignored here and reported when the material is processed.
+    imageFiles = set()
+    for material in materialsNode:
+        for texture in textureTypes:
+            materialTextureNode = get_node_by_path(material, texture.gltfPathParts)
+            if materialTextureNode is None:
+                continue
+            image = imagesNode[texturesNode[materialTextureNode['index']]['source']]
+            imageUri = image.get('uri')
+            if imageUri is None:
+                continue
+            imageFile = find_image_file(os.path.join(gltfDir, imageUri))
+            if imageFile is not None:
+                imageFiles.add(imageFile)
 
-def process_gltf_file(inputFileName):
-    print(f'\nProcessing {inputFileName}...')
+    with ThreadPoolExecutor() as executor:
+        for imageFile in imageFiles:
+            executor.submit(get_image_channel_count, imageFile)
 
-    with open(inputFileName, 'r') as infile:
-        gltf = json.load(infile)
+materialDefinitions : List[MaterialDefinition] = []
+materialCountsPerModel : Dict[str, int] = {}
 
+def process_gltf_file(inputFileName, gltf):
     if NV_TEXTURE_SWIZZLE_EXTENSION_NAME in gltf.get('extensionsUsed', []):
         print(f'The asset already uses {NV_TEXTURE_SWIZZLE_EXTENSION_NAME}, skipping.')
         return
@@ -287,6 +388,10 @@ def process_gltf_file(inputFileName):
         print('The asset doesn\'t have any textures, skipping.')
         return
     
+    gltfDir = os.path.dirname(inputFileName)
+
+    prefetch_image_channel_counts(materialsNode, texturesNode, imagesNode, gltfDir)
+
     # Go over the materials in the GLTF file, create a manifest file and a compression task for each material.
     for materialIndex, material in enumerate(materialsNode):
         materialName = material.get('name', f'Material')
@@ -294,8 +399,6 @@ def process_gltf_file(inputFileName):
         print()
         print(f'Material: "{materialName}"')
 
-        gltfDir = os.path.dirname(inputFileName)
-
         manifest = ManifestState(textures = [])
 
         # Add all supported textures that are present in the material to the manifest.
@@ -325,15 +428,30 @@ def process_gltf_file(inputFileName):
             materialName = materialName,
             materialIndexInModel = materialIndex,
             manifestTextures = manifest.textures,
+            manifestHash = get_manifest_hash(manifest.textures),
             newImageNode = newImageNode)
         
         materialDefinitions.append(matdef)
 
     return gltf
 
-gltfObjects = {}
+# The same GLTF file may be listed more than once, parse and convert every file only once.
+inputFiles = []
+normalizedInputFiles = set()
 for inputFileName in args.inputFiles:
-    gltfObjects[inputFileName] = process_gltf_file(inputFileName)
+    normalizedPath = os.path.normcase(os.path.abspath(inputFileName))
+    if normalizedPath not in normalizedInputFiles:
+        normalizedInputFiles.add(normalizedPath)
+        inputFiles.append(inputFileName)
+
+# Load the GLTF files on a thread pool so that reading the files overlaps, but process them in order
+# on this thread to keep the output and the material order deterministic.
+gltfObjects = {}
+with ThreadPoolExecutor(max_workers=8) as executor:
+    gltfFutures = [executor.submit(load_json_file, inputFileName) for inputFileName in inputFiles]
+    for inputFileName, gltfFuture in zip(inputFiles, gltfFutures):
+        print(f'\nProcessing {inputFileName}...')
+        gltfObjects[inputFileName] = process_gltf_file(inputFileName, gltfFuture.result())
 print()
 
 materialCountsPerName = {}
@@ -341,32 +459,34 @@ def deduplicate_material_name(matdef: MaterialDefinition):
     # Deduplicate material names.
     # Sometimes, multiple glTF materials have the same name, and we need distinct names to associate
     # a single .ntc file with each material. Append _{count} to duplicate names.
-    if matdef.materialName in materialCountsPerName:
-        # Get the previous count and update the dictionary
-        count = materialCountsPerName[matdef.materialName]
-        count += 1
-        materialCountsPerName[matdef.materialName] = count
+    # Get the previous count and update the dictionary, a name that hasn't been seen yet gets a count of 1.
+    count = materialCountsPerName.get(matdef.materialName, 0) + 1
+    materialCountsPerName[matdef.materialName] = count
 
+    if count > 1:
         # Print the message, rename the material.
         newMaterialName = f'{matdef.materialName}_{count}'
         print(f'Renaming "{matdef.materialName}" to "{newMaterialName}"')
         matdef.materialName = newMaterialName
-    else:
-        # This is not a duplicate name yet, store a count of 1.
-        materialCountsPerName[matdef.materialName] = 1
-
 
 tasks : List[ntc.Arguments] = []
 
-for materialIndex in range(len(materialDefinitions)):
-    matdef = materialDefinitions[materialIndex]
-    for searchIndex in range(materialIndex):
-        matdef2 = materialDefinitions[searchIndex]
-        if matdef.manifestTextures == matdef2.manifestTextures:
-            print(f'Material [{get_file_basename(matdef.modelFileName)} / {matdef.materialName}] uses the same textures as '
-                  f'[{get_file_basename(matdef2.modelFileName)} / {matdef2.materialName}], merging.')
-            matdef.references = matdef2
-            break
+# The first material with each unique set of textures, by manifest hash
+materialsByManifest : Dict[bytes, MaterialDefinition] = {}
+
+# The manifest files are written in the background while the materials and GLTF files are processed,
+# they only need to be complete when compression starts.
+manifestWriter = ThreadPoolExecutor(max_workers=8)
+manifestWriteFutures = []
+
+for matdef in materialDefinitions:
+    matdef2 = materialsByManifest.get(matdef.manifestHash)
+    if matdef2 is not None:
+        print(f'Material [{get_file_basename(matdef.modelFileName)} / {matdef.materialName}] uses the same textures as '
+              f'[{get_file_basename(matdef2.modelFileName)} / {matdef2.materialName}], merging.')
+        matdef.references = matdef2
+    else:
+        materialsByManifest[matdef.manifestHash] = matdef
 
     if matdef.references is None:
         deduplicate_material_name(matdef)
@@ -375,11 +495,9 @@ for materialIndex in range(len(materialDefinitions)):
         matdef.ntcFileName = os.path.join(args.output, f'{matdef.materialName}.ntc')
         ntcFileName = matdef.ntcFileName
 
-        with open(matdef.manifestFileName, 'w') as manifestFile:
-            # Package the textures into a full manifest
-            manifest = { 'textures': matdef.manifestTextures }
-            # Save the JSON file
-            json.dump(manifest, manifestFile, indent=2)
+        # Package the textures into a full manifest and save it
+        manifestWriteFutures.append(manifestWriter.submit(save_manifest_file, matdef.manifestFileName,
+                                                          { 'textures': matdef.manifestTextures }))
 
         if args.skipExisting and os.path.exists(matdef.ntcFileName):
             print(f'Output file {matdef.ntcFileName} exists, skipping.')
@@ -411,7 +529,6 @@ for materialIndex in range(len(materialDefinitions)):
     # Patch the new NTC file name into the GLTF image node
     matdef.newImageNode['uri'] = ntcFileNameRelativeToGltf
 
-
 def deduplicate_gltf_ntc_images(gltf):
     imagesNode = gltf['images']
     ntcFileToFirstImage = {}
@@ -439,17 +556,19 @@ def deduplicate_gltf_ntc_images(gltf):
     if len(imagesToDelete) == 0:
         return
     
-    # Delete the duplicate images
-    deletedCount = 0
-    for imageIndex in imagesToDelete:
-        del imagesNode[imageIndex - deletedCount]
-
-        # Shift the image mapping down for all images above this one
-        for idx2 in range(len(imageMapping)):
-            if imageMapping[idx2] >= imageIndex - deletedCount:
-                imageMapping[idx2] -= 1
+    # Delete the duplicate images in one pass, deleting them one by one would move the tail of the list every time
+    imagesToDelete = set(imagesToDelete)
+    imagesNode[:] = [image for imageIndex, image in enumerate(imagesNode) if imageIndex not in imagesToDelete]
 
-        deletedCount += 1
+    # Every remaining image moves down by the number of images deleted before it.
+    # The duplicates map to their first occurrence, which is never deleted.
+    shiftedIndices = []
+    deletedCount = 0
+    for imageIndex in range(len(imageMapping)):
+        shiftedIndices.append(imageIndex - deletedCount)
+        if imageIndex in imagesToDelete:
+            deletedCount += 1
+    imageMapping = [shiftedIndices[imageIndex] for imageIndex in imageMapping]
 
     # Patch the texture nodes with new image indices
     for textureNode in gltf['textures']:
@@ -470,7 +589,7 @@ def deduplicate_gltf_ntc_images(gltf):
 
 def deduplicate_gltf_ntc_textures(gltf):
     texturesNode = gltf['textures']
-    hashToFirstTexture = {}
+    swizzleToFirstTexture = {}
     textureIndex = 0
     textureMapping = list(range(len(texturesNode)))
     texturesToDelete = []
@@ -480,15 +599,12 @@ def deduplicate_gltf_ntc_textures(gltf):
         if swizzleExt is not None:
             assert len(swizzleExt['options']) == 1
             for optionNode in swizzleExt['options']:
-                swizzleHash = optionNode['source']
-                bitOffset = 16
-                for ch in optionNode['channels']:
-                    swizzleHash = swizzleHash ^ (max(ch, 0) << bitOffset)
-                    bitOffset += 4
+                # Textures are equal when they take the same channels from the same image
+                swizzleKey = (optionNode['source'], tuple(optionNode['channels']))
 
-                firstOccurence = hashToFirstTexture.get(swizzleHash)
+                firstOccurence = swizzleToFirstTexture.get(swizzleKey)
                 if firstOccurence is None:
-                    hashToFirstTexture[swizzleHash] = textureIndex
+                    swizzleToFirstTexture[swizzleKey] = textureIndex
                 else:
                     texturesToDelete.append(textureIndex)
                     textureMapping[textureIndex] = firstOccurence
@@ -498,22 +614,24 @@ def deduplicate_gltf_ntc_textures(gltf):
     if len(texturesToDelete) == 0:
         return
     
-    # Delete the duplicate textures
-    deletedCount = 0
-    for textureIndex in texturesToDelete:
-        del texturesNode[textureIndex - deletedCount]
+    # Delete the duplicate textures in one pass, deleting them one by one would move the tail of the list every time
+    texturesToDelete = set(texturesToDelete)
+    texturesNode[:] = [texture for textureIndex, texture in enumerate(texturesNode) if textureIndex not in texturesToDelete]
 
-        # Shift the mapping down for all images above this one
-        for idx2 in range(len(textureMapping)):
-            if textureMapping[idx2] >= textureIndex - deletedCount:
-                textureMapping[idx2] -= 1
-
-        deletedCount += 1
+    # Every remaining texture moves down by the number of textures deleted before it.
+    # The duplicates map to their first occurrence, which is never deleted.
+    shiftedIndices = []
+    deletedCount = 0
+    for textureIndex in range(len(textureMapping)):
+        shiftedIndices.append(textureIndex - deletedCount)
+        if textureIndex in texturesToDelete:
+            deletedCount += 1
+    textureMapping = [shiftedIndices[textureIndex] for textureIndex in textureMapping]
 
     # Patch the material nodes with new texture indices
     for materialNode in gltf['materials']:
         for texture in textureTypes:
-            materialTextureNode = get_node_by_path(materialNode, texture.gltfPath)
+            materialTextureNode = get_node_by_path(materialNode, texture.gltfPathParts)
             if materialTextureNode is None:
                 continue
             textureIndex = materialTextureNode['index']
@@ -521,7 +639,7 @@ def deduplicate_gltf_ntc_textures(gltf):
     
 
 
-for inputFileName in args.inputFiles:
+for inputFileName in inputFiles:
     if inputFileName not in materialCountsPerModel:
         continue
     
@@ -540,9 +658,12 @@ for inputFileName in args.inputFiles:
 
     parts = os.path.splitext(inputFileName)
     newFileName = f'{parts[0]}.ntc.gltf'
-    with open(newFileName, 'w') as newFile:
-        json.dump(gltf, newFile, indent = 4)
+    save_gltf_file(newFileName, gltf)
 
+# Wait for the manifest files, and report any errors that happened while writing them
+for future in manifestWriteFutures:
+    future.result()
+manifestWriter.shutdown()
 
 if args.dryRun:
     sys.exit(0)
@@ -551,20 +672,27 @@ if len(tasks) == 0:
     print('Nothing to compress, exiting.')
     sys.exit(0)
 
-maxNtcFilePathLen = max([len(args.saveCompressed) for args in tasks])
+maxNtcFilePathLen = max((len(task.saveCompressed) for task in tasks), default=0)
+
+# Status line template with the output file name column width filled in
+statusLineFormat = f'[{{completed:2}} of {{total:2}}] {{fileName:{maxNtcFilePathLen}}} : {{bpp}} bpp, {{psnr}} dB{{warning}}'
 
 def task_ready(task, result, originalTaskCount, tasksCompleted):
 
     # Delete the manifest file unless instructed to keep it.
+    # A failure here is not worth stopping the other compression tasks for.
     if not args.keepManifests:
-        os.unlink(task.loadManifest)
+        try:
+            os.unlink(task.loadManifest)
+        except OSError as e:
+            print(f'WARNING: Couldn\'t delete {task.loadManifest}: {e.strerror}')
 
     # Print the status output
     bpp = f'{result.bitsPerPixel:.2f}' if result.bitsPerPixel else 'N/A'
     psnr = f'{result.overallPsnr:.2f}' if result.overallPsnr else 'N/A'
     warning = ' <-- WARNING' if (result.overallPsnr and result.overallPsnr <= 10) else ''
-    print(f'[{tasksCompleted:2} of {originalTaskCount:2}] {task.saveCompressed:{maxNtcFilePathLen}}'
-            f' : {bpp} bpp, {psnr} dB{warning}')
+    print(statusLineFormat.format(completed=tasksCompleted, total=originalTaskCount, fileName=task.saveCompressed,
+                                  bpp=bpp, psnr=psnr, warning=warning))
 
 print()
 print('Starting compression...')